@@ -1,8 +1,9 @@
+import os
 import sys
 import time
+import queue
 import select
 import threading
-from copy import deepcopy
 from typing import Callable
 
 from dataclasses import dataclass
@@ -11,7 +12,16 @@ from enum import Enum
 from pyalsa import alsahcontrol
 
 from device_listener import DeviceListener
-from datastructures import WaveFormat, DeviceEvent
+from datastructures import WaveFormat, DeviceEvent, Emission
+
+try:
+    from _alsa_listener import ffi, lib
+except ImportError:
+    print("Compiling bindings, this will only be done on the first run.")
+    import alsa_listener_build
+
+    alsa_listener_build.run_build()
+    from _alsa_listener import ffi, lib
 
 LOOPBACK_ACTIVE = "PCM Slave Active"
 LOOPBACK_CHANNELS = "PCM Slave Channels"
@@ -19,6 +29,11 @@ LOOPBACK_FORMAT = "PCM Slave Format"
 LOOPBACK_RATE = "PCM Slave Rate"
 GADGET_CAP_RATE = "Capture Rate"
 
+# Poll timeout in seconds, limits how long stop() has to wait for the polling thread.
+POLL_TIMEOUT = 0.5
+# Max number of extra passes over pending events after a wakeup of the polling loop.
+MAX_DRAIN_PASSES = 4
+
 INTERFACE_PCM = alsahcontrol.interface_id["PCM"]
 INTERFACE_MIXER = alsahcontrol.interface_id["MIXER"]
 
@@ -77,68 +92,156 @@ class SampleFormat(Enum):
     DSD_U32_BE = 52
 
 
-def alsa_format_to_cdsp(fmt):
-    if fmt == SampleFormat.S16_LE:
-        return "S16LE"
-    if fmt == SampleFormat.S24_3LE:
-        return "S24LE3"
-    if fmt == SampleFormat.S24_LE:
-        return "S24LE"
-    if fmt == SampleFormat.S32_LE:
-        return "S32LE"
-    if fmt == SampleFormat.FLOAT_LE:
-        return "FLOAT32LE"
-    if fmt == SampleFormat.FLOAT64_LE:
-        return "FLOAT64LE"
+# Map the raw ALSA sample format values to CamillaDSP format names.
+# Formats not supported by CamillaDSP are missing, and look up as None.
+CDSP_FORMATS = {
+    SampleFormat.S16_LE.value: "S16LE",
+    SampleFormat.S24_3LE.value: "S24LE3",
+    SampleFormat.S24_LE.value: "S24LE",
+    SampleFormat.S32_LE.value: "S32LE",
+    SampleFormat.FLOAT_LE.value: "FLOAT32LE",
+    SampleFormat.FLOAT64_LE.value: "FLOAT64LE",
+}
+
+
+def alsa_strerror(err):
+    return ffi.string(lib.snd_strerror(err)).decode()
 
 
-@dataclass
+@dataclass(slots=True)
 class Control:
     index: int | None
     element: alsahcontrol.Element | None
-    value_transform_func: Callable | None
+    value_transform_func: Callable
+    info_type: int
 
 
-class AlsaControlListener(DeviceListener):
-    def __init__(self, device, debounce_time=0.05):
+class PollFdCollector:
+    # Collects the fds that HControl.register_poll() registers with it
+    def __init__(self):
+        self.fds = []
+
+    def register(self, fd, events):
+        self.fds.append(fd)
 
-        self.on_change = None
+
+class AlsaControlListener(DeviceListener):
+    def __init__(
+        self,
+        device,
+        debounce_time=0.05,
+        max_delay=0.5,
+        thread_affinity=None,
+        thread_priority=None,
+        thread_name=None,
+    ):
+
+        # No-op until a callback is set, so events can be sent without checking for None
+        self.on_change = lambda _event: None
+        # Events are passed to the callback from a separate thread,
+        # so that a slow callback does not delay the handling of control events.
+        self.event_queue = queue.SimpleQueue()
+        self.callback_thread = None
 
         self.debounce_time = debounce_time
+        self.max_delay = max_delay
+        # Optional scheduling settings for the polling and callback threads.
+        # The affinity is a set of CPU numbers, and the priority is a nice value.
+        # This can be used to keep the threads off the cores that run the audio processing.
+        self.thread_affinity = thread_affinity
+        self.thread_priority = thread_priority
+        self.thread_name = thread_name
         self.get_card_device_subdevice(device)
 
         self.hctl = alsahcontrol.HControl(
             self._card, mode=alsahcontrol.open_mode["NONBLOCK"]
         )
+        # A second, read only, handle to the same card, used for reading values
+        # by numid via the native binding. It is not subscribed to events.
+        self.native_ctl = self.open_native_ctl(self._card)
 
         self.all_device_controls = self.hctl.list()
+        self.control_index = {}
+        for idx, iface, dev, subdev, name, _ in self.all_device_controls:
+            # keep the first match, like a linear scan would
+            self.control_index.setdefault((name, iface, dev, subdev), idx)
 
-        self.ctl_loopback_active = self.find_control(LOOPBACK_ACTIVE, INTERFACE_PCM)
-        self.ctl_loopback_channels = self.find_control(LOOPBACK_CHANNELS, INTERFACE_PCM)
-        self.ctl_loopback_format = self.find_control(
-            LOOPBACK_FORMAT, INTERFACE_PCM, value_transform_func=SampleFormat
-        )
-        self.ctl_loopback_rate = self.find_control(LOOPBACK_RATE, INTERFACE_PCM)
+        # Set by the element callbacks when one of the monitored controls changes.
+        self.controls_changed = False
+
+        # A gadget is described by its capture rate control alone,
+        # only look for the loopback controls when there is none.
         self.ctl_gadget_rate = self.find_control(GADGET_CAP_RATE, INTERFACE_PCM)
+        if self.ctl_gadget_rate is not None:
+            self.ctl_loopback_active = None
+            self.ctl_loopback_channels = None
+            self.ctl_loopback_format = None
+            self.ctl_loopback_rate = None
+        else:
+            self.ctl_loopback_active = self.find_control(
+                LOOPBACK_ACTIVE, INTERFACE_PCM, value_transform_func=bool
+            )
+            self.ctl_loopback_channels = self.find_control(
+                LOOPBACK_CHANNELS, INTERFACE_PCM
+            )
+            self.ctl_loopback_format = self.find_control(
+                LOOPBACK_FORMAT, INTERFACE_PCM, value_transform_func=CDSP_FORMATS.get
+            )
+            self.ctl_loopback_rate = self.find_control(LOOPBACK_RATE, INTERFACE_PCM)
+        # The controls in the order read_loopback_state() unpacks them
+        self.loopback_controls = (
+            self.ctl_loopback_active,
+            self.ctl_loopback_rate,
+            self.ctl_loopback_channels,
+            self.ctl_loopback_format,
+        )
+        # Which controls describe the device does not change,
+        # pick the matching way to read the state once here.
+        if self.ctl_gadget_rate is not None:
+            self.read_state = self.read_gadget_state
+        else:
+            self.read_state = self.read_loopback_state
 
-        self.poller = select.poll()
+        # register_poll() only calls register(fd, events) on the given object,
+        # and the POLL* and EPOLL* event flags have the same values,
+        # so an epoll object can be used directly.
+        self.poller = select.epoll()
         self.hctl.register_poll(self.poller)
+        self.poll_fds = PollFdCollector()
+        self.hctl.register_poll(self.poll_fds)
 
         self.poll_thread = None
-        self.wave_format = self.read_wave_format()
-        self.is_active = self.check_if_active()
+        self.running = False
+        self.is_active, self.wave_format = self.read_state()
 
-    def find_control(self, name, interface, value_transform_func=None):
+    def find_control(self, name, interface, value_transform_func=int):
         index = self.find_element(name, interface)
         if index is None:
             return None
         element = alsahcontrol.Element(self.hctl, index)
         if element is None:
             return None
+        element.setCallback(self.on_element_event)
+        info = alsahcontrol.Info(element)
         return Control(
-            index=index, element=element, value_transform_func=value_transform_func
+            index=index,
+            element=element,
+            value_transform_func=value_transform_func,
+            info_type=info.type,
         )
 
+    def open_native_ctl(self, card):
+        ctl_ptr = ffi.new("snd_ctl_t**")
+        res = lib.snd_ctl_open(ctl_ptr, card.encode(), lib.SND_CTL_READONLY)
+        if res < 0:
+            raise RuntimeError(
+                f"Unable to open control device {card}: {alsa_strerror(res)}"
+            )
+        return ffi.gc(ctl_ptr[0], lib.snd_ctl_close)
+
+    def on_element_event(self, element, mask):
+        self.controls_changed = True
+
     def get_card_device_subdevice(self, dev):
         parts = dev.split(",")
         if len(parts) >= 3:
@@ -156,93 +259,206 @@ class AlsaControlListener(DeviceListener):
             device = self.device_nbr
         if subdevice is None:
             subdevice = self.subdev_nbr
-        found = None
-        for idx, iface, dev, subdev, name, _ in self.all_device_controls:
-            if (
-                name == wanted_name
-                and dev == device
-                and subdev == subdevice
-                and iface == interface
-            ):
-                found = idx
-                print(f"Found control '{wanted_name}' with index {idx}")
-                break
+        found = self.control_index.get((wanted_name, interface, device, subdevice))
+        if found is not None:
+            print(f"Found control '{wanted_name}' with index {found}")
         return found
 
-    def read_element_value(self, elem):
-        if elem is None:
-            return None
-        info = alsahcontrol.Info(elem)
-        val = alsahcontrol.Value(elem)
-        values = val.get_tuple(info.type, info.count)
-        val.set_tuple(info.type, values)
-        val.read()
-        return values[0]
+    def read_element_value(self, ctl: Control):
+        # Values may be read from several threads at once,
+        # so the error code gets a new pointer for every call.
+        err = ffi.new("int*")
+        value = lib.read_value(self.native_ctl, ctl.index, ctl.info_type, err)
+        if err[0] < 0:
+            raise RuntimeError(
+                f"Unable to read control {ctl.index}: {alsa_strerror(err[0])}"
+            )
+        return value
 
     def read_control_value(self, ctl: Control | None):
         if ctl is None:
             return None
-        value = self.read_element_value(ctl.element)
-        if ctl.value_transform_func is not None:
-            return ctl.value_transform_func(value)
-        return value
-
-    def check_if_active(self):
-        gadget_rate = self.read_control_value(self.ctl_gadget_rate)
-        if gadget_rate is not None:
-            return gadget_rate > 0
-        return self.read_control_value(self.ctl_loopback_active)
+        return ctl.value_transform_func(self.read_element_value(ctl))
 
-    def read_wave_format(self):
-        loopback_rate = self.read_control_value(self.ctl_loopback_rate)
-        loopback_channels = self.read_control_value(self.ctl_loopback_channels)
-        loopback_format = self.read_control_value(self.ctl_loopback_format)
+    def read_gadget_state(self):
+        # A gadget only provides the sample rate, which is zero when inactive
         gadget_rate = self.read_control_value(self.ctl_gadget_rate)
-        if gadget_rate is not None:
-            return WaveFormat(
-                sample_format=None, channels=None, sample_rate=gadget_rate
-            )
-        return WaveFormat(
-            sample_format=alsa_format_to_cdsp(loopback_format),
+        wave_format = WaveFormat(
+            sample_format=None, channels=None, sample_rate=gadget_rate
+        )
+        return gadget_rate > 0, wave_format
+
+    def read_loopback_state(self):
+        # Read each control once, and derive both the active state and the wave format
+        (
+            loopback_active,
+            loopback_rate,
+            loopback_channels,
+            loopback_format,
+        ) = [self.read_control_value(ctl) for ctl in self.loopback_controls]
+        wave_format = WaveFormat(
+            sample_format=loopback_format,
             channels=loopback_channels,
             sample_rate=loopback_rate,
         )
+        return loopback_active, wave_format
+
+    def read_wave_format(self):
+        _, wave_format = self.read_state()
+        return wave_format
 
-    def determine_action(self):
-        new_wave_format = self.read_wave_format()
-        new_active = self.check_if_active()
+    def determine_action(self, emit):
+        new_active, new_wave_format = self.read_state()
         if not self.is_active and new_active:
             self.is_active = True
-            event = DeviceEvent.STARTED
-            event.set_data(deepcopy(new_wave_format))
-            self.emit_event(event)
+            emit(Emission(DeviceEvent.STARTED, new_wave_format))
         elif self.is_active and not new_active:
             self.is_active = False
-            event = DeviceEvent.STOPPED
-            self.emit_event(event)
+            emit(Emission(DeviceEvent.STOPPED))
         elif self.is_active and new_active and self.wave_format != new_wave_format:
-            stop_event = DeviceEvent.STOPPED
-            self.emit_event(stop_event)
-            start_event = DeviceEvent.STARTED
-            start_event.set_data(deepcopy(new_wave_format))
-            self.emit_event(start_event)
+            emit(Emission(DeviceEvent.STOPPED))
+            emit(Emission(DeviceEvent.STARTED, new_wave_format))
         self.wave_format = new_wave_format
 
-    def emit_event(self, event):
-        if self.on_change is not None:
-            self.on_change(event)
-
     def pollingloop(self):
+        # A change is handled right away, unless it arrives within debounce_time
+        # of the previous action. Then it starts a burst, which is handled once
+        # there have been no changes for debounce_time, or when max_delay
+        # has passed since the first change of the burst.
+        last_action = None
+        first_change = None
+        last_change = None
+        while self.running:
+            timeout = POLL_TIMEOUT
+            if first_change is not None:
+                now = time.monotonic()
+                timeout = max(
+                    0,
+                    min(
+                        self.debounce_time - (now - last_change),
+                        self.max_delay - (now - first_change),
+                    ),
+                )
+            changed = False
+            if self.poller.poll(timeout):
+                changed = self.handle_control_events()
+                # Drain events that arrived meanwhile, but return to the loop
+                # after a few passes, so the running flag and the debounce
+                # deadlines are checked even if the fd never stops being ready.
+                for _ in range(MAX_DRAIN_PASSES):
+                    if not self.poller.poll(0):
+                        break
+                    changed = self.handle_control_events() or changed
+            now = time.monotonic()
+            if changed:
+                if first_change is None:
+                    if last_action is None or now - last_action >= self.debounce_time:
+                        self.determine_action(self.event_queue.put)
+                        last_action = time.monotonic()
+                        continue
+                    first_change = now
+                last_change = now
+            if first_change is not None and (
+                now - last_change >= self.debounce_time
+                or now - first_change >= self.max_delay
+            ):
+                self.determine_action(self.event_queue.put)
+                last_action = time.monotonic()
+                first_change = None
+
+    def handle_control_events(self):
+        # Process the pending control events.
+        # Returns True if any of the monitored controls changed,
+        # events for other controls of the card are of no interest.
+        self.hctl.handle_events()
+        changed = self.controls_changed
+        self.controls_changed = False
+        return changed
+
+    def get_poll_fds(self):
+        """
+        Return the file descriptors to watch for control events.
+        This is used together with process_events() to handle the events
+        from an existing event loop, instead of calling run().
+        """
+        return list(self.poll_fds.fds)
+
+    def process_events(self):
+        """
+        Process the pending control events, and call the callback for any resulting events.
+        Call this when one of the fds from get_poll_fds() becomes readable.
+        The callback is called directly from this method, and no debouncing is done.
+        """
+        if self.handle_control_events():
+            self.determine_action(self.on_change)
+
+    def callbackloop(self):
         while True:
-            pollres = self.poller.poll()
-            if pollres:
-                time.sleep(self.debounce_time)
-                self.hctl.handle_events()
-                self.determine_action()
+            emission = self.event_queue.get()
+            if emission is None:
+                # Sent by stop()
+                break
+            self.on_change(emission)
+
+    def start_thread(self, target, name):
+        # The scheduling settings are applied by the new thread itself, before it
+        # does any work, so it never runs with the wrong affinity or priority.
+        # Wait for this to finish, and raise any error in the calling thread.
+        settings_applied = threading.Event()
+        errors = []
+
+        def thread_main():
+            try:
+                if self.thread_affinity is not None:
+                    os.sched_setaffinity(0, self.thread_affinity)
+                if self.thread_priority is not None:
+                    os.setpriority(os.PRIO_PROCESS, 0, self.thread_priority)
+            except Exception as e:
+                errors.append(e)
+                return
+            finally:
+                settings_applied.set()
+            target()
+
+        thread = threading.Thread(target=thread_main, name=name, daemon=True)
+        thread.start()
+        settings_applied.wait()
+        if errors:
+            thread.join()
+            raise errors[0]
+        return thread
 
     def run(self):
-        self.poll_thread = threading.Thread(target=self.pollingloop, daemon=True)
-        self.poll_thread.start()
+        if self.running:
+            raise RuntimeError("Already listening to events")
+        self.running = True
+        callback_thread_name = None
+        if self.thread_name is not None:
+            callback_thread_name = f"{self.thread_name}-callback"
+        try:
+            self.callback_thread = self.start_thread(
+                self.callbackloop, callback_thread_name
+            )
+            self.poll_thread = self.start_thread(self.pollingloop, self.thread_name)
+        except Exception:
+            # Unable to apply the thread settings, stop anything already started
+            self.running = False
+            if self.callback_thread is not None:
+                self.event_queue.put(None)
+                self.callback_thread.join()
+                self.callback_thread = None
+            raise
+
+    def stop(self):
+        if not self.running:
+            raise RuntimeError("Not listening to events")
+        self.running = False
+        self.poll_thread.join()
+        self.poll_thread = None
+        # Let the callback thread finish any queued events before it exits
+        self.event_queue.put(None)
+        self.callback_thread.join()
+        self.callback_thread = None
 
     def set_on_change(self, function):
         self.on_change = function
@@ -252,8 +468,8 @@ if __name__ == "__main__":
     device = sys.argv[1]
     listener = ControlListener(device, debounce_time=0.05)
 
-    def notifier(params):
-        print(params, params.data)
+    def notifier(emission):
+        print(emission.event, emission.data)
 
     listener.set_on_change(notifier)
     listener.run()
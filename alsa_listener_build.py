@@ -0,0 +1,65 @@
+from cffi import FFI
+
+ffibuilder = FFI()
+
+# Build a native binding to the parts of the ALSA ctl API needed to read control values.
+# pyalsa is still used for finding the controls and for listening to events,
+# this binding only replaces the Info/Value/tuple handling when reading a value.
+
+ffibuilder.set_source(
+    "_alsa_listener",
+    r"""
+    #include <alsa/asoundlib.h>
+
+    // Read the first value of the element with the given numid.
+    // The type is one of the SND_CTL_ELEM_TYPE_* values.
+    // Returns the value, and sets err to zero on success or a negative error code.
+    static long long read_value(snd_ctl_t *ctl, unsigned int numid, int type, int *err)
+    {
+        snd_ctl_elem_value_t *val;
+        snd_ctl_elem_value_alloca(&val);
+        snd_ctl_elem_value_set_numid(val, numid);
+        *err = snd_ctl_elem_read(ctl, val);
+        if (*err < 0) {
+            return 0;
+        }
+        *err = 0;
+        switch (type) {
+        case SND_CTL_ELEM_TYPE_BOOLEAN:
+            return snd_ctl_elem_value_get_boolean(val, 0);
+        case SND_CTL_ELEM_TYPE_INTEGER:
+            return snd_ctl_elem_value_get_integer(val, 0);
+        case SND_CTL_ELEM_TYPE_INTEGER64:
+            return snd_ctl_elem_value_get_integer64(val, 0);
+        case SND_CTL_ELEM_TYPE_ENUMERATED:
+            return snd_ctl_elem_value_get_enumerated(val, 0);
+        default:
+            *err = -EINVAL;
+            return 0;
+        }
+    }
+    """,
+    libraries=["asound"],
+)
+
+ffibuilder.cdef(
+    """
+typedef struct _snd_ctl snd_ctl_t;
+
+#define SND_CTL_READONLY ...
+
+int snd_ctl_open(snd_ctl_t **ctl, const char *name, int mode);
+int snd_ctl_close(snd_ctl_t *ctl);
+const char *snd_strerror(int errnum);
+
+long long read_value(snd_ctl_t *ctl, unsigned int numid, int type, int *err);
+"""
+)
+
+
+def run_build():
+    ffibuilder.compile(verbose=True)
+
+
+if __name__ == "__main__":
+    run_build()
@@ -1,6 +1,6 @@
 import cffi
 
-from datastructures import WaveFormat, DeviceEvent
+from datastructures import WaveFormat, DeviceEvent, Emission
 from device_listener import DeviceListener
 
 try:
@@ -142,11 +142,8 @@ class CAListener(DeviceListener):
 def property_listener(inObjectID, _inNumberAddresses, _inAddresses, inClientData):
     self = ffi.from_handle(inClientData)
     wave_format = self.read_wave_format()
-    stop_event = DeviceEvent.STOPPED
-    self.emit_event(stop_event)
-    start_event = DeviceEvent.STARTED
-    start_event.set_data(wave_format)
-    self.emit_event(start_event)
+    self.emit_event(Emission(DeviceEvent.STOPPED))
+    self.emit_event(Emission(DeviceEvent.STARTED, wave_format))
     return 0
 
 
@@ -155,8 +152,8 @@ def demo(device):
 
     listener = CAListener(device)
 
-    def dummy_callback(params):
-        print(params, params.data)
+    def dummy_callback(emission):
+        print(emission.event, emission.data)
 
     print(listener.read_wave_format())
     listener.set_on_change(dummy_callback)
@@ -48,10 +48,13 @@ class CamillaController:
         stop_found = False
         # Iterate through the list from the end
         for n, event in enumerate(reversed(self.events)):
-            if not stop_found and event == DeviceEvent.STOPPED:
+            if not stop_found and event.event == DeviceEvent.STOPPED:
                 # This is the first stop event we encounter
                 stop_found = True
-            elif stop_found and event in (DeviceEvent.STARTED, DeviceEvent.STOPPED):
+            elif stop_found and event.event in (
+                DeviceEvent.STARTED,
+                DeviceEvent.STOPPED,
+            ):
                 # This start or stop event is followed by a stop, mark it for removal
                 events_to_remove.append(n)
         orig_len = len(self.events)
@@ -71,7 +74,7 @@ class CamillaController:
                 event = self.events.pop(0)
                 # handle each event
                 print(event)
-                if event == DeviceEvent.STARTED:
+                if event.event == DeviceEvent.STARTED:
                     wave_format = event.data
                     # re-read wave format here!
                     if self.listener is not None:
@@ -84,7 +87,7 @@ class CamillaController:
                     )
                     self.stop_cdsp()
                     self.start_cdsp()
-                elif event == DeviceEvent.STOPPED:
+                elif event.event == DeviceEvent.STOPPED:
                     print("Device stopped")
                     self.stop_cdsp()
 
@@ -8,32 +8,25 @@ class DeviceEvent(Enum):
     STOPPED = auto()
     STARTED = auto()
 
-    def __new__(cls, value):
-        obj = object.__new__(cls)
-        obj._value_ = value
-        obj._data = None
-        return obj
 
-    def set_data(self, value):
-        """
-        Set the custom data property of the enum.
-        """
-        self._data = value
-
-    @property
-    def data(self):
-        """
-        Getter for the data property
-        """
-        return self._data
-
-
-@dataclass
+@dataclass(frozen=True, slots=True)
 class WaveFormat:
     """
     A class representing a wave format, that consists of the sample rate,
     sample format and number of channels.
+    Instances are immutable, and can be shared and compared freely.
     """
     sample_rate: int | None
     sample_format: str | None
-    channels: int | None
\ No newline at end of file
+    channels: int | None
+
+
+@dataclass(frozen=True, slots=True)
+class Emission:
+    """
+    A class representing an event sent by a device listener,
+    together with the optional data belonging to the event.
+    For STARTED events, the data is the new WaveFormat.
+    """
+    event: DeviceEvent
+    data: WaveFormat | None = None
\ No newline at end of file
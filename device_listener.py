@@ -15,10 +15,17 @@ class DeviceListener:
         """
         pass
 
+    def stop(self):
+        """
+        Stop listening for events from the device.
+        """
+        pass
+
     def set_on_change(self, function):
         """
         Provide a callback function that gets called when some event occurs.
-        The callback is called once per event, and will be called with a DeviceEvent as argument.
+        The callback is called once per event, and will be called with an Emission as argument,
+        holding the DeviceEvent and any data that belongs to it.
         """
         pass
 